@@ -1,4 +1,41 @@
-from .api import Mail, Attachment, Connection, Message, SenderError
 from ._version import __version__
 
-__all__ = [SenderError, Mail, Attachment, Connection, Message, __version__]
+__all__ = [
+    "SenderError",
+    "Mail",
+    "Attachment",
+    "Connection",
+    "Message",
+    "SendResult",
+    "DomainScheduler",
+    "DomainStats",
+    "ShardedSender",
+    "ShardStats",
+    "__version__",
+]
+
+# Loaded on first access so that rendering messages (``async_sender.message``)
+# does not import the SMTP client.
+_MESSAGE = {"SenderError", "Message", "Attachment"}
+_API = {"Mail", "Connection", "SendResult", "DomainScheduler", "DomainStats"}
+_SHARDED = {"ShardedSender", "ShardStats"}
+
+
+def __getattr__(name):
+    if name in _MESSAGE:
+        from . import message
+
+        return getattr(message, name)
+    if name in _API:
+        from . import api
+
+        return getattr(api, name)
+    if name in _SHARDED:
+        from . import sharded
+
+        return getattr(sharded, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | _MESSAGE | _API | _SHARDED)
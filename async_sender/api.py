@@ -1,26 +1,22 @@
-import ssl
 import time
-from typing import Union, Iterable, Sequence, Optional
-from email import charset as ch
-from email.encoders import encode_base64
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.utils import make_msgid, formatdate
-from email.header import Header
-
-USASCII = ch.Charset("us-ascii")
-
-try:
-    import aiosmtplib
-except ImportError:  # pragma: no cover
-    aiosmtplib = None
-
-ch.add_charset("utf-8", ch.SHORTEST, None, "utf-8")
-
-
-class SenderError(Exception):
-    pass
+import asyncio
+import collections
+from typing import (
+    TYPE_CHECKING,
+    Union,
+    Iterable,
+    Optional,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+)
+
+from .message import SenderError, Message, Attachment  # noqa: F401
+
+if TYPE_CHECKING:  # pragma: no cover
+    import ssl
+    from concurrent.futures import Executor
 
 
 class Mail:
@@ -50,6 +46,9 @@ class Mail:
         verification. Mutually exclusive with ``client_cert``/
         ``client_key``.
     :param cert_bundle: Path to certificate bundle, for TLS verification.
+    :param executor: An :class:`concurrent.futures.Executor` used to render
+        messages off the event loop.  Base64 encoding holds the GIL, so a
+        thread pool only compresses attachments in parallel.
     """
 
     def __init__(
@@ -67,8 +66,9 @@ class Mail:
         validate_certs: bool = True,
         client_cert: str = None,
         client_key: str = None,
-        tls_context: ssl.SSLContext = None,
+        tls_context: "ssl.SSLContext" = None,
         cert_bundle: str = None,
+        executor: "Executor" = None,
     ):
         self.host = hostname
         self.port = port
@@ -85,6 +85,7 @@ class Mail:
         self.client_key = client_key
         self.tls_context = tls_context
         self.cert_bundle = cert_bundle
+        self.executor = executor
 
     @property
     def connection(self) -> "Connection":
@@ -102,181 +103,447 @@ class Mail:
 
         async with self.connection as connection:
             for message in messages:
-                if self.from_address and not message.from_address:
-                    message.from_address = self.from_address
-                message.validate()
+                self._prepare(message)
                 await connection.send(message)
 
     async def send_message(self, *args, **kwargs):
         """Shortcut for send."""
         await self.send(Message(*args, **kwargs))
 
-
-class Message:
-    """One email message.
-
-    :param subject: message subject
-    :param to: message recipient, should be one or a list of addresses
-    :param body: plain text content body
-    :param html: HTML content body
-    :param from_address: message sender, can be one address or a two-element tuple
-    :param cc: CC list, should be one or a list of addresses
-    :param bcc: BCC list, should be one or a list of addresses
-    :param attachments: a list of attachment instances
-    :param reply_to: reply-to address
-    :param date: message send date, seconds since the Epoch,
-                 default to be time.time()
-    :param charset: message charset, default to be 'utf-8'
-    :param extra_headers: a dictionary of extra headers
-    :param mail_options: a list of ESMTP options used in MAIL FROM commands
-    :param rcpt_options: a list of ESMTP options used in RCPT commands
+    async def send_stream(
+        self,
+        source: Union[Iterable, AsyncIterable],
+        concurrency: int = 1,
+        factory: Callable[..., "Message"] = None,
+    ) -> AsyncIterator["SendResult"]:
+        """
+        Sends messages pulled lazily from a sync or async iterable and
+        yields one :class:`SendResult` per message as soon as it is sent.
+
+        At most ``concurrency`` connections are opened and every connection
+        takes the next item from ``source`` only after its previous message
+        has been sent, so memory stays bounded no matter how long the source
+        is.  Results are yielded in completion order.  A message which fails
+        because the connection broke is reported as failed and the next
+        message is sent over a new connection.
+
+        :param source: iterable or async iterable of messages (or of rows
+            when ``factory`` is given), e.g. a database cursor.
+        :param concurrency: number of connections sending in parallel.
+        :param factory: optional callable which turns one item of ``source``
+            into a :class:`Message` instance.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+
+        items = _aiter(source)
+        lock = asyncio.Lock()
+        results = asyncio.Queue(maxsize=concurrency)
+        done = object()
+
+        async def next_message():
+            async with lock:
+                try:
+                    item = await items.__anext__()
+                except StopAsyncIteration:
+                    return done
+            return factory(item) if factory is not None else item
+
+        async def worker():
+            connection = None
+            try:
+                while True:
+                    message = await next_message()
+                    if message is done:
+                        break
+                    try:
+                        self._prepare(message)
+                        if connection is None:
+                            connection = await self.connection.__aenter__()
+                        response = await connection.send(message)
+                    except SenderError as e:
+                        result = SendResult(message, error=e)
+                    except (OSError, *_connection_errors()) as e:
+                        result = SendResult(message, error=e)
+                        if _is_broken(connection, e):
+                            # reconnect for the next message
+                            connection.server.close()
+                            connection = None
+                    else:
+                        result = SendResult(message, response=response)
+                    await results.put(result)
+
+                if connection is not None:
+                    await _quit(connection)
+                    connection = None
+            except Exception as e:
+                await results.put(e)
+            else:
+                await results.put(done)
+            finally:
+                if connection is not None:
+                    connection.server.close()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        try:
+            running = len(workers)
+            while running:
+                result = await results.get()
+                if result is done:
+                    running -= 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def _prepare(self, message: "Message"):
+        if not isinstance(message, Message):
+            raise SenderError(f"Expected a Message instance, got {message!r}")
+        if self.from_address and not message.from_address:
+            message.from_address = self.from_address
+        message.validate()
+
+
+class SendResult:
+    """Outcome of sending one message with :meth:`Mail.send_stream`.
+
+    :param message: the message instance
+    :param response: server response, a tuple of rejected recipients and
+        the final DATA response message
+    :param error: exception raised while validating or sending the message
+    :param recipients: envelope recipients this result is for, ``None``
+        means all recipients of the message
     """
 
     def __init__(
         self,
-        subject: str = None,
-        to: Union[str, Iterable] = None,
-        body: str = None,
-        html: str = None,
-        from_address: Union[str, Iterable] = None,
-        cc: Union[str, Iterable] = None,
-        bcc: Union[str, Iterable] = None,
-        attachments: Union["Attachment", Sequence["Attachment"]] = None,
-        reply_to: Union[str, Iterable] = None,
-        date: Optional[int] = None,
-        charset: str = "utf-8",
-        extra_headers: dict = None,
-        mail_options: list = None,
-        rcpt_options: list = None,
+        message: "Message",
+        response: tuple = None,
+        error: Exception = None,
+        recipients: set = None,
     ):
-        self.message_id = make_msgid()
-        self.subject = subject
-        self.body = body
-        self.html = html
-        self.attachments = attachments or []
-        self.date = date
-        self.charset = charset
-        self.extra_headers = extra_headers
-        self.mail_options = mail_options or []
-        self.rcpt_options = rcpt_options or []
-
-        self.to = set([to] if isinstance(to, str) else to or [])
-        self.from_address = from_address
-        self.cc = set([cc] if isinstance(cc, str) else cc or [])
-        self.bcc = set([bcc] if isinstance(bcc, str) else bcc or [])
-        self.reply_to = reply_to
+        self.message = message
+        self.response = response
+        self.error = error
+        self.recipients = recipients
 
     @property
-    def to_address(self):
-        return self.to | self.cc | self.bcc
-
-    def validate(self):
-        """Do email message validation."""
-        if not (self.to or self.cc or self.bcc):
-            raise SenderError("Does not specify any recipients(to,cc,bcc)")
-        if not self.from_address:
-            raise SenderError("Does not specify from_address(sender)")
-
-        if any(self.subject and (c in self.subject) for c in "\n\r"):
-            raise SenderError("newline is not allowed in subject")
-
-    def as_string(self) -> str:
-        """The message string."""
-        if self.date is None:
-            self.date = time.time()
-
-        msg = MIMEText(self.body, "plain", self.charset)
-        if not self.html:
-            if len(self.attachments) > 0:
-                # plain text with attachments
-                msg = MIMEMultipart()
-                msg.attach(MIMEText(self.body, "plain", self.charset))
-        else:
-            msg = MIMEMultipart()
-            alternative = MIMEMultipart("alternative")
-            alternative.attach(MIMEText(self.body, "plain", self.charset))
-            alternative.attach(MIMEText(self.html, "html", self.charset))
-            msg.attach(alternative)
-
-        # For improve deliver-ability
-        # https://github.com/theruziev/async_sender/issues/228
-        if self.subject is not None and self.subject.isascii():
-            msg["Subject"] = Header(self.subject, USASCII)
-        else:
-            msg["Subject"] = Header(self.subject, self.charset)
-
-        msg["From"] = self.from_address
-        msg["To"] = ", ".join(self.to)
-        msg["Date"] = formatdate(self.date, localtime=True)
-        msg["Message-ID"] = self.message_id
-        if self.cc:
-            msg["Cc"] = ", ".join(self.cc)
-        if self.reply_to:
-            msg["Reply-To"] = self.reply_to
-        if self.extra_headers:
-            for key, value in self.extra_headers.items():
-                msg[key] = value
-
-        for attachment in self.attachments:
-            f = MIMEBase(*attachment.content_type.split("/"))
-            f.set_payload(attachment.data)
-            encode_base64(f)
-            if attachment.filename is None:
-                filename = str(None)
-            else:
-                filename = attachment.filename
-            try:
-                filename.encode("ascii")
-            except UnicodeEncodeError:
-                filename = ("UTF8", "", filename)
-            f.add_header("Content-Disposition", attachment.disposition, filename=filename)
-            for key, value in attachment.headers.items():
-                f.add_header(key, value)
-            msg.attach(f)
+    def ok(self) -> bool:
+        return self.error is None
 
-        return msg.as_string()
 
-    def as_bytes(self) -> bytes:
-        return self.as_string().encode(self.charset or "utf-8")
+class DomainStats:
+    """Throughput and latency of messages sent to one destination domain.
 
-    def __str__(self):
-        return self.as_string()  # pragma: no cover
+    :param domain: recipient domain
+    """
 
-    def attach(self, *attachment: "Attachment"):
-        """Adds one or a list of attachments to the message.
+    def __init__(self, domain: str):
+        self.domain = domain
+        self.sent = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.started = None
+        self.finished = None
 
-        :param attachment: Attachment instance.
-        """
-        self.attachments.extend(attachment)
+    @property
+    def count(self) -> int:
+        return self.sent + self.failed
 
-    def attach_attachment(self, *args, **kwargs):
-        """Shortcut for attach."""
-        self.attach(Attachment(*args, **kwargs))
+    @property
+    def average_latency(self) -> float:
+        """Average seconds spent sending one message."""
+        return self.total_latency / self.count if self.count else 0.0
 
+    @property
+    def throughput(self) -> float:
+        """Messages per second between the first and the last message."""
+        if not self.count or self.finished == self.started:
+            return 0.0
+        return self.count / (self.finished - self.started)
+
+    def record(self, started: float, ok: bool):
+        now = time.monotonic()
+        latency = now - started
+        if self.started is None or started < self.started:
+            self.started = started
+        self.finished = now
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+
+class _DomainQueue:
+    def __init__(self, domain: str, concurrency: int, timeout: Optional[float]):
+        self.queue = asyncio.Queue()
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.workers = 0
+        # queued or being sent, at most max_pending
+        self.pending = 0
+        # read from the source while the domain had no room
+        self.parked = collections.deque()
+        self.stats = DomainStats(domain)
 
-class Attachment:
-    """File attachment information.
 
-    :param filename: filename
-    :param content_type: file mimetype
-    :param data: raw data
-    :param disposition: content-disposition, default to be 'attachment'
-    :param headers: a dictionary of headers, default to be {}
+class DomainScheduler:
+    """Sends messages through separate queues per recipient domain so a slow
+    or failing destination (greylisting, tarpitting) only delays its own
+    messages.
+
+    A message with recipients in several domains is split: every domain
+    gets one transaction with only its own recipients in the envelope, sent
+    under that domain's limits.  The headers are the same for every part.
+
+    Every domain gets up to ``concurrency`` connections of its own which are
+    opened when the domain has queued messages and closed once its queue is
+    drained.  Each message must be delivered within ``timeout`` seconds,
+    otherwise it is reported as failed and its connection is dropped.
+
+    :param mail: one mail instance
+    :param concurrency: connections per domain
+    :param timeout: seconds allowed for delivering one message, including
+        connecting.  ``None`` disables the budget.
+    :param limits: a dictionary of per domain overrides, e.g.
+        ``{"example.com": {"concurrency": 4, "timeout": 30}}``
+    :param max_pending: maximum number of messages (or parts of split
+        messages) queued or being sent per domain
+    :param max_parked: maximum number of messages read from the source and
+        held back because their domain already has ``max_pending`` ones.
+        Reading from the source only waits when this is reached, so a slow
+        domain does not stop other domains from getting new messages.
     """
 
     def __init__(
         self,
-        filename: str = None,
-        content_type: str = None,
-        data=None,
-        disposition: str = "attachment",
-        headers: dict = None,
+        mail: "Mail",
+        concurrency: int = 1,
+        timeout: Optional[float] = None,
+        limits: Dict[str, dict] = None,
+        max_pending: int = 1000,
+        max_parked: int = 10000,
     ):
-        self.filename = filename
-        self.content_type = content_type
-        self.data = data
-        self.disposition = disposition
-        self.headers = headers if headers else {}
+        if concurrency < 1 or max_pending < 1 or max_parked < 1:
+            raise ValueError("concurrency, max_pending and max_parked must be at least 1")
+        self.mail = mail
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.limits = limits or {}
+        self.max_pending = max_pending
+        self.max_parked = max_parked
+        self.stats: Dict[str, DomainStats] = {}
+
+    async def send(
+        self,
+        source: Union[Iterable, AsyncIterable],
+        factory: Callable[..., "Message"] = None,
+    ) -> AsyncIterator["SendResult"]:
+        """
+        Sends messages from a sync or async iterable and yields one
+        :class:`SendResult` per message and recipient domain in completion
+        order, :attr:`SendResult.recipients` tells which recipients it is
+        for.  Per domain statistics are collected in :attr:`stats`.
+
+        :param source: iterable or async iterable of messages (or of rows
+            when ``factory`` is given).
+        :param factory: optional callable which turns one item of ``source``
+            into a :class:`Message` instance.
+        """
+        items = _aiter(source)
+        results = asyncio.Queue()
+        queues: Dict[str, _DomainQueue] = {}
+        tasks = set()
+        outstanding = 0
+        parked = 0
+        unparked = asyncio.Event()
+        done = object()
+
+        def spawn(coro):
+            task = asyncio.ensure_future(coro)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        def dispatch(state, part):
+            state.pending += 1
+            state.queue.put_nowait(part)
+            if state.workers < state.concurrency:
+                state.workers += 1
+                spawn(self._worker(state, results))
+
+        async def reader():
+            nonlocal outstanding, parked
+            try:
+                async for item in items:
+                    message = factory(item) if factory is not None else item
+                    for domain, recipients in _recipients_by_domain(message).items():
+                        if domain not in queues:
+                            queues[domain] = self._domain_queue(domain)
+                        state = queues[domain]
+                        outstanding += 1
+                        if state.pending < self.max_pending:
+                            dispatch(state, (message, recipients))
+                            continue
+                        state.parked.append((message, recipients))
+                        parked += 1
+                        while parked >= self.max_parked:
+                            unparked.clear()
+                            await unparked.wait()
+            except Exception as e:
+                await results.put(e)
+            else:
+                await results.put(done)
+
+        spawn(reader())
+        try:
+            reading = True
+            while reading or outstanding:
+                result = await results.get()
+                if result is done:
+                    reading = False
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    state, result = result
+                    outstanding -= 1
+                    state.pending -= 1
+                    if state.parked:
+                        parked -= 1
+                        unparked.set()
+                        dispatch(state, state.parked.popleft())
+                    yield result
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _domain_queue(self, domain: str) -> _DomainQueue:
+        limits = self.limits.get(domain, {})
+        state = _DomainQueue(
+            domain,
+            limits.get("concurrency", self.concurrency),
+            limits.get("timeout", self.timeout),
+        )
+        self.stats[domain] = state.stats
+        return state
+
+    async def _worker(self, state: _DomainQueue, results: asyncio.Queue):
+        connection = None
+
+        async def deliver(message, recipients):
+            nonlocal connection
+            self.mail._prepare(message)
+            if connection is None:
+                connection = await Connection(self.mail).__aenter__()
+            return await connection.send(message, recipients)
+
+        try:
+            while True:
+                try:
+                    message, recipients = state.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    # drained, new messages for this domain get a new worker
+                    state.workers -= 1
+                    break
+                started = time.monotonic()
+                try:
+                    response = await asyncio.wait_for(deliver(message, recipients), state.timeout)
+                except SenderError as e:
+                    result = SendResult(message, error=e, recipients=recipients)
+                except (asyncio.TimeoutError, OSError, *_connection_errors()) as e:
+                    result = SendResult(message, error=e, recipients=recipients)
+                    # a failed connect or login already closed its socket and
+                    # leaves connection unset
+                    if _is_broken(connection, e):
+                        connection.server.close()
+                        connection = None
+                else:
+                    result = SendResult(message, response=response, recipients=recipients)
+                state.stats.record(started, result.ok)
+                await results.put((state, result))
+
+            if connection is not None:
+                await _quit(connection)
+                connection = None
+        except Exception as e:
+            await results.put(e)
+        finally:
+            if connection is not None:
+                connection.server.close()
+
+
+def _aiter(source: Union[Iterable, AsyncIterable]) -> AsyncIterator:
+    if hasattr(source, "__aiter__"):
+        return source.__aiter__()
+
+    async def gen():
+        for item in source:
+            yield item
+
+    return gen()
+
+
+def _recipients_by_domain(message: "Message") -> Dict[str, set]:
+    """Envelope recipients of a message grouped by their domain."""
+    from email.utils import parseaddr
+
+    if not isinstance(message, Message) or not message.to_address:
+        # sent as is, so that validation reports the error
+        return {"": None}
+    domains = {}
+    for address in message.to_address:
+        domain = parseaddr(address)[1].rpartition("@")[2].lower()
+        domains.setdefault(domain, set()).add(address)
+    return domains
+
+
+def _is_broken(connection: Optional["Connection"], error: Exception) -> bool:
+    """Whether an open connection can not be used after ``error``.  A
+    rejected message keeps it usable unless the server hung up, e.g. after
+    a 421 reply."""
+    if connection is None:
+        return False
+    return not isinstance(error, _message_errors()) or not connection.server.is_connected
+
+
+async def _quit(connection: "Connection"):
+    """Quits an open connection, closes it when the server is gone."""
+    try:
+        await connection.__aexit__(None, None, None)
+    except (OSError, *_connection_errors()):
+        connection.server.close()
+
+
+def _smtplib():
+    """Imports aiosmtplib on first use, ``None`` when it is not installed."""
+    try:
+        import aiosmtplib
+    except ImportError:  # pragma: no cover
+        return None
+    return aiosmtplib
+
+
+def _message_errors() -> tuple:
+    """Errors which reject one message but leave the connection usable."""
+    aiosmtplib = _smtplib()
+    if aiosmtplib is None:
+        return ()  # pragma: no cover
+    return (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPResponseException)
+
+
+def _connection_errors() -> tuple:
+    """Errors which leave the connection unusable."""
+    aiosmtplib = _smtplib()
+    if aiosmtplib is None:
+        return ()  # pragma: no cover
+    return (aiosmtplib.SMTPException,)
 
 
 class Connection:
@@ -289,11 +556,11 @@ class Connection:
 
     def __init__(self, mail):
         self.mail = mail
-        if aiosmtplib is None:
+        if _smtplib() is None:
             raise RuntimeError("Please install 'aiosmtplib'")  # pragma: no cover
 
     async def __aenter__(self):
-        server = aiosmtplib.SMTP(
+        server = _smtplib().SMTP(
             hostname=self.mail.host,
             port=self.mail.port,
             use_tls=self.mail.use_tls,
@@ -306,16 +573,21 @@ class Connection:
             cert_bundle=self.mail.cert_bundle,
         )
 
-        await server.connect()
+        try:
+            await server.connect()
 
-        if self.mail.use_ehlo:
-            await server.ehlo()
+            if self.mail.use_ehlo:
+                await server.ehlo()
 
-        if self.mail.use_starttls:
-            await server.starttls()
+            if self.mail.use_starttls:
+                await server.starttls()
 
-        if self.mail.username and self.mail.password:
-            await server.login(self.mail.username, self.mail.password)
+            if self.mail.username and self.mail.password:
+                await server.login(self.mail.username, self.mail.password)
+        except BaseException:
+            # failed or cancelled (e.g. by a timeout) while setting up
+            server.close()
+            raise
 
         self.server = server
 
@@ -324,15 +596,22 @@ class Connection:
     async def __aexit__(self, exc_type, exc_value, exc_tb):
         await self.server.quit()
 
-    async def send(self, message: "Message"):
+    async def _render(self, message: "Message") -> bytes:
+        if self.mail.executor is None:
+            return message.as_bytes()
+        return await message.as_bytes_async(self.mail.executor)
+
+    async def send(self, message: "Message", recipients: Iterable[str] = None):
         """Send one message instance.
 
         :param message: one message instance.
+        :param recipients: envelope recipients, default to be all recipients
+            of the message.
         """
-        await self.server.sendmail(
+        return await self.server.sendmail(
             message.from_address,
-            message.to_address,
-            message.as_bytes(),
+            message.to_address if recipients is None else recipients,
+            await self._render(message),
             mail_options=message.mail_options,
             rcpt_options=message.rcpt_options,
         )
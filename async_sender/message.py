@@ -0,0 +1,390 @@
+"""Message rendering.  Importing this module does not load the SMTP client,
+:mod:`ssl` or :mod:`asyncio`; the :mod:`email` packages needed for rendering
+are imported on first use.
+"""
+
+import copy
+import time
+from typing import TYPE_CHECKING, Union, Iterable, Sequence, Optional, Dict
+
+if TYPE_CHECKING:  # pragma: no cover
+    from concurrent.futures import Executor
+
+_charset_registered = False
+
+
+def _register_charset():
+    """Sends UTF-8 bodies as 8bit instead of base64.
+
+    This changes the global :mod:`email.charset` registry, so it is done on
+    the first render instead of at import time.
+    """
+    global _charset_registered
+    if not _charset_registered:
+        from email import charset as ch
+
+        ch.add_charset("utf-8", ch.SHORTEST, None, "utf-8")
+        _charset_registered = True
+
+
+class SenderError(Exception):
+    pass
+
+
+class Message:
+    """One email message.
+
+    :param subject: message subject
+    :param to: message recipient, should be one or a list of addresses
+    :param body: plain text content body
+    :param html: HTML content body
+    :param from_address: message sender, can be one address or a two-element tuple
+    :param cc: CC list, should be one or a list of addresses
+    :param bcc: BCC list, should be one or a list of addresses
+    :param attachments: a list of attachment instances
+    :param reply_to: reply-to address
+    :param date: message send date, seconds since the Epoch,
+                 default to be time.time()
+    :param charset: message charset, default to be 'utf-8'
+    :param extra_headers: a dictionary of extra headers
+    :param mail_options: a list of ESMTP options used in MAIL FROM commands
+    :param rcpt_options: a list of ESMTP options used in RCPT commands
+    :param dedupe_attachments: send identical attachments only once when
+        the dropped one stays reachable: an inline attachment with a
+        Content-ID is referenced by the Content-ID of the kept one, an
+        attachment with the same filename is a repeat
+    :param compress_threshold: gzip text-like attachments of at least this
+        many bytes, default to be None (never compress)
+    """
+
+    def __init__(
+        self,
+        subject: str = None,
+        to: Union[str, Iterable] = None,
+        body: str = None,
+        html: str = None,
+        from_address: Union[str, Iterable] = None,
+        cc: Union[str, Iterable] = None,
+        bcc: Union[str, Iterable] = None,
+        attachments: Union["Attachment", Sequence["Attachment"]] = None,
+        reply_to: Union[str, Iterable] = None,
+        date: Optional[int] = None,
+        charset: str = "utf-8",
+        extra_headers: dict = None,
+        mail_options: list = None,
+        rcpt_options: list = None,
+        dedupe_attachments: bool = False,
+        compress_threshold: Optional[int] = None,
+    ):
+        from email.utils import make_msgid
+
+        self.message_id = make_msgid()
+        self.subject = subject
+        self.body = body
+        self.html = html
+        self.attachments = attachments or []
+        self.date = date
+        self.charset = charset
+        self.extra_headers = extra_headers
+        self.mail_options = mail_options or []
+        self.rcpt_options = rcpt_options or []
+        self.dedupe_attachments = dedupe_attachments
+        self.compress_threshold = compress_threshold
+
+        self.to = set([to] if isinstance(to, str) else to or [])
+        self.from_address = from_address
+        self.cc = set([cc] if isinstance(cc, str) else cc or [])
+        self.bcc = set([bcc] if isinstance(bcc, str) else bcc or [])
+        self.reply_to = reply_to
+
+    @property
+    def to_address(self):
+        return self.to | self.cc | self.bcc
+
+    def validate(self):
+        """Do email message validation."""
+        if not (self.to or self.cc or self.bcc):
+            raise SenderError("Does not specify any recipients(to,cc,bcc)")
+        if not self.from_address:
+            raise SenderError("Does not specify from_address(sender)")
+
+        if any(self.subject and (c in self.subject) for c in "\n\r"):
+            raise SenderError("newline is not allowed in subject")
+
+    def as_string(self, executor: "Executor" = None) -> str:
+        """The message string.
+
+        :param executor: optional executor which runs one encoding job per
+            distinct attachment.
+        """
+        attachments, html, keys = self._attachment_plan()
+        unique = list(dict.fromkeys(keys))
+        if executor is not None and len(unique) > 1:
+            encoded = executor.map(_encode_payload, *zip(*unique))
+        else:
+            encoded = [_encode_payload(*key) for key in unique]
+        results = dict(zip(unique, encoded))
+        return self._render(attachments, html, [results[key] for key in keys])
+
+    def as_bytes(self, executor: "Executor" = None) -> bytes:
+        return self.as_string(executor).encode(self.charset or "utf-8")
+
+    async def as_bytes_async(self, executor: "Executor" = None) -> bytes:
+        """The message bytes.  Encoding the attachments and assembling the
+        message run in ``executor`` so the running event loop is not blocked.
+
+        Base64 encoding holds the GIL, so with a thread pool only gzip
+        compression of several attachments actually runs in parallel.  A
+        process pool encodes in parallel too but has to copy every payload
+        to the worker once.
+
+        :param executor: executor to use, default to be the loop's default executor.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if self.date is None:
+            self.date = time.time()
+        attachments, html, keys = self._attachment_plan()
+        unique = list(dict.fromkeys(keys))
+        encoded = await asyncio.gather(
+            *(loop.run_in_executor(executor, _encode_payload, *key) for key in unique)
+        )
+        results = dict(zip(unique, encoded))
+        # the render only needs the headers, not the attachment data again
+        message = copy.copy(self)
+        message.attachments = []
+        attachments = [
+            Attachment(a.filename, a.content_type, None, a.disposition, a.headers)
+            for a in attachments
+        ]
+        string = await loop.run_in_executor(
+            executor, message._render, attachments, html, [results[key] for key in keys]
+        )
+        return string.encode(self.charset or "utf-8")
+
+    def _attachment_plan(self) -> tuple:
+        """Returns the attachments to send, the HTML body referencing them and
+        one ``(content_type, data, compress)`` encoding job per attachment."""
+        attachments = self.attachments
+        html = self.html
+        if self.dedupe_attachments:
+            attachments, content_ids = _dedupe_attachments(attachments)
+            if html and content_ids:
+                html = _replace_content_ids(html, content_ids)
+
+        keys = []
+        for attachment in attachments:
+            compress = (
+                self.compress_threshold is not None
+                and attachment.disposition == "attachment"
+                and _is_compressible(attachment.content_type)
+                and len(attachment.data or "") >= self.compress_threshold
+            )
+            data = attachment.data
+            if isinstance(data, (bytearray, memoryview)):
+                data = bytes(data)
+            keys.append((attachment.content_type, data, compress))
+        return attachments, html, keys
+
+    def _render(self, attachments: Sequence["Attachment"], html: str, encoded: list) -> str:
+        from email.mime.text import MIMEText
+        from email.mime.base import MIMEBase
+        from email.mime.multipart import MIMEMultipart
+        from email.utils import formatdate
+        from email.header import Header
+
+        if self.date is None:
+            self.date = time.time()
+
+        _register_charset()
+        msg = MIMEText(self.body, "plain", self.charset)
+        if not self.html:
+            if len(attachments) > 0:
+                # plain text with attachments
+                msg = MIMEMultipart()
+                msg.attach(MIMEText(self.body, "plain", self.charset))
+        else:
+            msg = MIMEMultipart()
+            alternative = MIMEMultipart("alternative")
+            alternative.attach(MIMEText(self.body, "plain", self.charset))
+            alternative.attach(MIMEText(html, "html", self.charset))
+            msg.attach(alternative)
+
+        # For improve deliver-ability
+        # https://github.com/theruziev/async_sender/issues/228
+        if self.subject is not None and self.subject.isascii():
+            msg["Subject"] = Header(self.subject, "us-ascii")
+        else:
+            msg["Subject"] = Header(self.subject, self.charset)
+
+        msg["From"] = self.from_address
+        msg["To"] = ", ".join(self.to)
+        msg["Date"] = formatdate(self.date, localtime=True)
+        msg["Message-ID"] = self.message_id
+        if self.cc:
+            msg["Cc"] = ", ".join(self.cc)
+        if self.reply_to:
+            msg["Reply-To"] = self.reply_to
+        if self.extra_headers:
+            for key, value in self.extra_headers.items():
+                msg[key] = value
+
+        for attachment, (content_type, payload, compressed) in zip(attachments, encoded):
+            f = MIMEBase(*content_type.split("/"))
+            f.set_payload(payload)
+            f["Content-Transfer-Encoding"] = "base64"
+            if attachment.filename is None:
+                filename = str(None)
+            else:
+                filename = attachment.filename
+            if compressed:
+                filename += ".gz"
+            try:
+                filename.encode("ascii")
+            except UnicodeEncodeError:
+                filename = ("UTF8", "", filename)
+            f.add_header("Content-Disposition", attachment.disposition, filename=filename)
+            for key, value in attachment.headers.items():
+                f.add_header(key, value)
+            msg.attach(f)
+
+        return msg.as_string()
+
+    def __str__(self):
+        return self.as_string()  # pragma: no cover
+
+    def attach(self, *attachment: "Attachment"):
+        """Adds one or a list of attachments to the message.
+
+        :param attachment: Attachment instance.
+        """
+        self.attachments.extend(attachment)
+
+    def attach_attachment(self, *args, **kwargs):
+        """Shortcut for attach."""
+        self.attach(Attachment(*args, **kwargs))
+
+
+class Attachment:
+    """File attachment information.
+
+    :param filename: filename
+    :param content_type: file mimetype
+    :param data: raw data
+    :param disposition: content-disposition, default to be 'attachment'
+    :param headers: a dictionary of headers, default to be {}
+    """
+
+    def __init__(
+        self,
+        filename: str = None,
+        content_type: str = None,
+        data=None,
+        disposition: str = "attachment",
+        headers: dict = None,
+    ):
+        self.filename = filename
+        self.content_type = content_type
+        self.data = data
+        self.disposition = disposition
+        self.headers = headers if headers else {}
+
+
+def _is_compressible(content_type: str) -> bool:
+    maintype, _, subtype = content_type.partition("/")
+    return (
+        maintype == "text"
+        or subtype in ("json", "xml", "csv", "javascript", "x-ndjson")
+        or subtype.endswith(("+json", "+xml"))
+    )
+
+
+def _encode_payload(content_type: str, data, compress: bool) -> tuple:
+    from email.encoders import encode_base64
+    from email.mime.base import MIMEBase
+
+    part = MIMEBase(*content_type.split("/"))
+    part.set_payload(data)
+    if compress:
+        import gzip
+
+        raw = part.get_payload(decode=True)
+        compressed = gzip.compress(raw, mtime=0)
+        if len(compressed) < len(raw):
+            content_type = "application/gzip"
+            part.set_payload(compressed)
+        else:
+            compress = False
+    encode_base64(part)
+    return content_type, part.get_payload(), compress
+
+
+def _dedupe_attachments(attachments: Sequence["Attachment"]) -> tuple:
+    """Drops attachments with the same content as an earlier one when the
+    dropped one can still be reached: an inline part with a Content-ID is
+    referenced through the Content-ID of the kept part, a part with the
+    same filename is a plain repeat.  Other parts are kept, so no named
+    file gets lost.
+
+    Returns the kept attachments and a dictionary which maps Content-IDs of
+    dropped attachments to the Content-ID of the kept one.
+    """
+    from email.utils import make_msgid
+
+    kept = []
+    groups = {}
+    content_ids = {}
+    for attachment in attachments:
+        data = attachment.data
+        if isinstance(data, (bytearray, memoryview)):
+            data = bytes(data)
+        indexes = groups.setdefault((attachment.content_type, data), [])
+        dropped = _content_id(attachment)
+
+        target = None
+        for i in indexes:
+            if kept[i].filename == attachment.filename:
+                target = i
+                break
+        if target is None and indexes and dropped is not None:
+            if attachment.disposition == "inline":
+                # prefer a part which is inline already
+                inline = [i for i in indexes if kept[i].disposition == "inline"]
+                target = (inline or indexes)[0]
+        if target is None:
+            indexes.append(len(kept))
+            kept.append(attachment)
+            continue
+
+        if dropped is None:
+            continue
+        first = kept[target]
+        headers = first.headers
+        if _content_id(first) is None:
+            headers = dict(headers, **{"Content-ID": make_msgid()})
+        disposition = "inline" if attachment.disposition == "inline" else first.disposition
+        if headers is not first.headers or disposition != first.disposition:
+            first = kept[target] = Attachment(
+                first.filename, first.content_type, first.data, disposition, headers
+            )
+        content_ids[dropped] = _content_id(first)
+    return kept, content_ids
+
+
+def _replace_content_ids(html: str, content_ids: Dict[str, str]) -> str:
+    """Replaces whole ``cid:`` references, so ``cid:img1`` does not touch
+    ``cid:img10``."""
+    import re
+
+    def replace(match):
+        return "cid:" + content_ids.get(match.group(1), match.group(1))
+
+    return re.sub(r"cid:([^\s\"'()<>]+)", replace, html)
+
+
+def _content_id(attachment: "Attachment") -> Optional[str]:
+    for key, value in attachment.headers.items():
+        if key.lower() == "content-id":
+            return value.strip("<>")
+    return None
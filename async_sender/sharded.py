@@ -0,0 +1,264 @@
+"""Sending engine which spreads rendering and sending over worker processes."""
+
+import os
+import time
+import copy
+import pickle
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import util
+from typing import Union, Iterable, AsyncIterable, AsyncIterator, Callable, Dict, List
+
+from .api import Mail, Connection, SendResult, _aiter, _connection_errors, _message_errors
+from .message import Message, SenderError
+
+# state of a worker process, set by _init_worker
+_worker = None
+
+
+class ShardStats:
+    """Messages sent by one worker process.
+
+    :param pid: worker process id
+    """
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.sent = 0
+        self.failed = 0
+        self.chunks = 0
+        self.busy = 0.0
+
+    @property
+    def count(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def throughput(self) -> float:
+        """Messages per second of time spent sending."""
+        return self.count / self.busy if self.busy else 0.0
+
+
+class ShardedSender:
+    """Sends messages from several worker processes, each one with its own
+    event loop and connections, so rendering and TLS use more than one core.
+
+    Messages are sent to the workers in chunks and results come back as
+    compact ``(response, error)`` tuples which are merged into one stream
+    of :class:`SendResult` instances.  Every worker keeps ``concurrency``
+    connections open across chunks, reconnects the ones which failed or
+    were closed by the server and quits them when it stops.
+
+    :param mail: one mail instance, copied into every worker.  Its
+        ``tls_context`` can not be shared between processes, use
+        ``client_cert``/``client_key``/``cert_bundle`` instead.
+    :param processes: number of worker processes, default to be the
+        number of CPUs
+    :param concurrency: connections per worker process
+    :param chunk_size: messages sent to a worker at once
+    :param max_chunks: chunks in flight, default to be twice the number of
+        processes
+    """
+
+    def __init__(
+        self,
+        mail: Mail,
+        processes: int = None,
+        concurrency: int = 1,
+        chunk_size: int = 100,
+        max_chunks: int = None,
+    ):
+        if mail.tls_context is not None:
+            raise ValueError("tls_context can not be shared between processes")
+        if (
+            concurrency < 1
+            or chunk_size < 1
+            or any(value is not None and value < 1 for value in (processes, max_chunks))
+        ):
+            raise ValueError("processes, concurrency, chunk_size and max_chunks must be at least 1")
+        self.mail = copy.copy(mail)
+        # attachments are encoded by the worker processes themselves
+        self.mail.executor = None
+        self.processes = processes or os.cpu_count() or 1
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks or 2 * self.processes
+        self.stats: Dict[int, ShardStats] = {}
+        self._pool = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        await self.aclose()
+
+    def close(self):
+        """Stops the worker processes, blocks until running chunks are done."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    async def aclose(self):
+        """Stops the worker processes without blocking the event loop."""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.processes,
+                initializer=_init_worker,
+                initargs=(self.mail, self.concurrency),
+            )
+        return self._pool
+
+    async def send(
+        self,
+        source: Union[Iterable, AsyncIterable],
+        factory: Callable[..., "Message"] = None,
+    ) -> AsyncIterator[SendResult]:
+        """
+        Sends messages from a sync or async iterable and yields one
+        :class:`SendResult` per message, chunk by chunk in completion order.
+        Messages are validated and get their default ``from_address`` and
+        date in this process, invalid ones fail without reaching a worker.
+        Per worker statistics are collected in :attr:`stats`, they only
+        count messages sent to the workers.
+
+        :param source: iterable or async iterable of messages (or of rows
+            when ``factory`` is given).
+        :param factory: optional callable which turns one item of ``source``
+            into a :class:`Message` instance, it is called in this process.
+        """
+        loop = asyncio.get_running_loop()
+        items = _aiter(source)
+        pending = {}
+        failed = deque()
+        exhausted = False
+
+        async def next_chunk() -> List["Message"]:
+            chunk = []
+            async for item in items:
+                message = factory(item) if factory is not None else item
+                try:
+                    self.mail._prepare(message)
+                except SenderError as e:
+                    failed.append(SendResult(message, error=e))
+                    continue
+                if message.date is None:
+                    message.date = time.time()
+                chunk.append(message)
+                if len(chunk) >= self.chunk_size:
+                    break
+            return chunk
+
+        try:
+            while True:
+                while not exhausted and len(pending) < self.max_chunks:
+                    chunk = await next_chunk()
+                    if len(chunk) < self.chunk_size:
+                        exhausted = True
+                    if chunk:
+                        future = loop.run_in_executor(self.pool, _send_chunk, chunk)
+                        pending[future] = chunk
+                while failed:
+                    yield failed.popleft()
+                if not pending:
+                    break
+
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    chunk = pending.pop(future)
+                    pid, busy, results = future.result()
+                    stats = self.stats.setdefault(pid, ShardStats(pid))
+                    stats.chunks += 1
+                    stats.busy += busy
+                    for message, (response, error) in zip(chunk, results):
+                        if error is None:
+                            stats.sent += 1
+                        else:
+                            stats.failed += 1
+                        yield SendResult(message, response=response, error=error)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class _Worker:
+    """State of a worker process: its event loop and long-lived connections."""
+
+    def __init__(self, mail: Mail, concurrency: int):
+        self.mail = mail
+        self.loop = asyncio.new_event_loop()
+        self.connections = [None] * concurrency
+
+    async def send_all(self, messages: List["Message"]) -> list:
+        results = [None] * len(messages)
+        items = iter(enumerate(messages))
+
+        async def sender(slot):
+            for i, message in items:
+                results[i] = await self.send(slot, message)
+
+        await asyncio.gather(*(sender(slot) for slot in range(len(self.connections))))
+        return results
+
+    async def send(self, slot: int, message: "Message") -> tuple:
+        connection = self.connections[slot]
+        try:
+            self.mail._prepare(message)
+            if connection is not None and not connection.server.is_connected:
+                # closed by the server while the worker was idle
+                connection.server.close()
+                connection = self.connections[slot] = None
+            if connection is None:
+                connection = self.connections[slot] = await Connection(self.mail).__aenter__()
+            return await connection.send(message), None
+        except SenderError as e:
+            return None, e
+        except (OSError, *_connection_errors()) as e:
+            if connection is not None and not isinstance(e, _message_errors()):
+                connection.server.close()
+                self.connections[slot] = None
+            return None, _picklable(e)
+
+    async def quit(self):
+        for connection in self.connections:
+            if connection is not None:
+                try:
+                    await connection.__aexit__(None, None, None)
+                except (OSError, *_connection_errors()):
+                    connection.server.close()
+        self.connections = [None] * len(self.connections)
+
+    def close(self):
+        self.loop.run_until_complete(self.quit())
+        self.loop.close()
+
+
+def _init_worker(mail: Mail, concurrency: int):
+    global _worker
+    _worker = _Worker(mail, concurrency)
+    # runs when the pool shuts the process down, unlike atexit
+    util.Finalize(None, _worker.close, exitpriority=10)
+
+
+def _send_chunk(messages: List["Message"]) -> tuple:
+    """Sends one chunk in a worker process, returns its pid, the seconds
+    spent and one ``(response, error)`` tuple per message."""
+    started = time.monotonic()
+    results = _worker.loop.run_until_complete(_worker.send_all(messages))
+    return os.getpid(), time.monotonic() - started, results
+
+
+def _picklable(error: Exception) -> Exception:
+    if error is None:
+        return None
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        return SenderError(repr(error))
+    return error
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Measures the cold import time of async_sender modules.
+
+Every import runs in a fresh interpreter with ``-X importtime``, the median
+cumulative time of the imported module is reported.
+
+    python scripts/import_time.py [-n 20] [module ...]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+MODULES = ["async_sender", "async_sender.message", "async_sender.api"]
+
+
+def import_time(module: str) -> int:
+    """Cumulative import time of ``module`` in microseconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in reversed(result.stderr.splitlines()):
+        _, _, cumulative, name = (part.strip() for part in line.replace(":", "|", 1).split("|"))
+        if name == module:
+            return int(cumulative)
+    raise RuntimeError(f"{module} was not imported")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=20, help="runs per module")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        times = [import_time(module) for _ in range(args.n)]
+        print(f"{module:<24} {statistics.median(times) / 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
+import asyncio
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import httpx
 import pytest
-from async_sender import Message, SenderError, Attachment, Mail
+from async_sender import Message, SenderError, Attachment, Mail, DomainScheduler, ShardedSender
 
 
 @pytest.fixture()
@@ -28,6 +34,71 @@ def get_emails():
     return factory
 
 
+class SpyExecutor(ThreadPoolExecutor):
+    """Thread pool which records the callables submitted to it."""
+
+    def __init__(self):
+        super().__init__(2)
+        self.calls = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.calls.append((fn, args))
+        return super().submit(fn, *args, **kwargs)
+
+
+@pytest.fixture()
+def spy_executor():
+    with SpyExecutor() as executor:
+        yield executor
+
+
+@pytest.fixture()
+def smtp_server():
+    """Minimal in-process SMTP server.  ``rcpt`` is an optional coroutine
+    which gets the RCPT address and returns the reply, a 421 reply closes
+    the connection.  Returns the server and a list of delivered envelopes."""
+
+    async def factory(rcpt=None):
+        delivered = []
+
+        async def handle(reader, writer):
+            writer.write(b"220 localhost ESMTP\r\n")
+            recipients = []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line[:4].upper()
+                if command in (b"EHLO", b"HELO"):
+                    reply = b"250 localhost"
+                elif command == b"RCPT":
+                    address = line.decode().split(":", 1)[1].strip().strip("<>")
+                    reply = (await rcpt(address) if rcpt else "250 OK").encode()
+                    if reply.startswith(b"421"):
+                        writer.write(reply + b"\r\n")
+                        break
+                    recipients.append(address)
+                elif command == b"DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    while await reader.readline() != b".\r\n":
+                        pass
+                    delivered.append(recipients)
+                    recipients = []
+                    reply = b"250 OK"
+                elif command == b"QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    break
+                else:
+                    reply = b"250 OK"
+                writer.write(reply + b"\r\n")
+            writer.close()
+
+        server = await asyncio.start_server(handle, "localhost", 0)
+        return server, server.sockets[0].getsockname()[1], delivered
+
+    return factory
+
+
 def test_subject():
     msg = Message("test")
     assert msg.subject in "test"
@@ -190,6 +261,99 @@ def test_attachment_unicode_filename():
     assert "UTF8''%E6%88%91%E7%9A%84%E6%B5%8B%E8%AF" "%95%E6%96%87%E6%A1%A3.txt" in str(msg)
 
 
+def test_dedupe_attachments():
+    msg = Message(
+        from_address="from@example.com",
+        to="to@example.com",
+        html='<img src="cid:logo2">',
+        dedupe_attachments=True,
+    )
+    msg.attach_attachment("logo.png", "image/png", b"logo", "inline", {"Content-ID": "<logo1>"})
+    msg.attach_attachment("logo.png", "image/png", b"logo", "inline", {"Content-ID": "<logo2>"})
+    msg.attach_attachment("other.png", "image/png", b"other")
+    source = str(msg)
+    assert source.count("filename=") == 2
+    assert "cid:logo1" in source
+    assert "cid:logo2" not in source
+    assert len(msg.attachments) == 3
+
+    # a dropped Content-ID which is a prefix of a kept one
+    msg = Message(
+        from_address="from@example.com",
+        to="to@example.com",
+        html='<img src="cid:img1"><img src="cid:img10">',
+        dedupe_attachments=True,
+    )
+    msg.attach_attachment("a.png", "image/png", b"a", "inline", {"Content-ID": "<img0>"})
+    msg.attach_attachment("a.png", "image/png", b"a", "inline", {"Content-ID": "<img1>"})
+    msg.attach_attachment("b.png", "image/png", b"b", "inline", {"Content-ID": "<img10>"})
+    source = str(msg)
+    assert '<img src="cid:img0"><img src="cid:img10">' in source
+
+    # same bytes under another name are kept, a repeated name is dropped
+    msg = Message(from_address="from@example.com", to="to@example.com", dedupe_attachments=True)
+    msg.attach_attachment("jan.csv", "text/csv", b"1,2")
+    msg.attach_attachment("feb.csv", "text/csv", b"1,2")
+    msg.attach_attachment("jan.csv", "text/csv", b"1,2")
+    source = str(msg)
+    assert source.count('filename="jan.csv"') == 1
+    assert source.count('filename="feb.csv"') == 1
+    assert "Content-ID" not in source
+
+
+def test_compress_attachments():
+    data = b"id,name\n" + b"1,test\n" * 1000
+    msg = Message(from_address="from@example.com", to="to@example.com", compress_threshold=1024)
+    msg.attach_attachment("export.csv", "text/csv", data)
+    msg.attach_attachment("small.csv", "text/csv", b"id,name\n")
+    source = str(msg)
+    assert 'filename="export.csv.gz"' in source
+    assert "Content-Type: application/gzip" in source
+    assert 'filename="small.csv"' in source
+    assert len(source) < len(data)
+
+
+def test_attachments_executor():
+    msg = Message(from_address="from@example.com", to="to@example.com")
+    for i in range(3):
+        msg.attach_attachment(f"{i}.txt", "text/plain", f"attachment {i}".encode())
+    with ThreadPoolExecutor(2) as executor:
+        assert msg.as_string(executor).count("Content-Disposition") == 3
+
+
+@pytest.mark.asyncio
+async def test_send_with_executor(clear_inbox, spy_executor):
+    await clear_inbox()
+
+    data = b"".join(b"%d,name%d\n" % (i, i) for i in range(1000))
+    msg = Message(from_address="from@example.com", to="to@example.com", compress_threshold=1024)
+    for i in range(3):
+        msg.attach_attachment(f"{i}.csv", "text/csv", data + bytes([i]))
+
+    await Mail(hostname="localhost", port=1025, executor=spy_executor).send(msg)
+
+    # only the encoding jobs and the final render leave the event loop
+    names = [fn.__name__ for fn, args in spy_executor.calls]
+    assert names == ["_encode_payload"] * 3 + ["_render"]
+    render, args = spy_executor.calls[-1]
+    assert render.__self__ is not msg
+    assert render.__self__.attachments == []
+    assert all(attachment.data is None for attachment in args[0])
+    assert msg.date is not None
+
+
+def test_render_only_import():
+    code = (
+        "import sys\n"
+        "from async_sender import Message\n"
+        "Message('subject', to='to@example.com', from_address='from@example.com').as_string()\n"
+        "print(' '.join(m for m in ('aiosmtplib', 'ssl', 'asyncio') if m in sys.modules))"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ""
+
+
 @pytest.mark.asyncio
 async def test_send_email(clear_inbox, get_emails):
     await clear_inbox()
@@ -208,3 +372,241 @@ async def test_send_email(clear_inbox, get_emails):
     assert msg.subject == email["subject"]
     assert msg.body in email["source"]
     assert msg.message_id in email["source"]
+
+
+@pytest.mark.asyncio
+async def test_send_stream(clear_inbox):
+    await clear_inbox()
+
+    async def messages():
+        for i in range(5):
+            yield Message(
+                from_address="from@example.com", subject=f"Stream {i}", to="to@example.com"
+            )
+        yield Message(from_address="from@example.com")
+
+    mail = Mail(hostname="localhost", port=1025)
+    results = [result async for result in mail.send_stream(messages(), concurrency=2)]
+    assert len(results) == 6
+    assert sum(result.ok for result in results) == 5
+    failed = [result for result in results if not result.ok]
+    assert isinstance(failed[0].error, SenderError)
+
+    async with httpx.AsyncClient() as client:
+        r = await client.get("http://localhost:1080/messages")
+        assert len(r.json()) == 5
+
+
+@pytest.mark.asyncio
+async def test_send_stream_factory(clear_inbox):
+    await clear_inbox()
+
+    rows = ({"email": f"to{i}@example.com"} for i in range(3))
+    mail = Mail(hostname="localhost", port=1025, from_address="from@example.com")
+    results = [
+        result
+        async for result in mail.send_stream(
+            rows, factory=lambda row: Message("Hello", to=row["email"])
+        )
+    ]
+    assert [result.message.to for result in results] == [
+        {"to0@example.com"},
+        {"to1@example.com"},
+        {"to2@example.com"},
+    ]
+    assert all(result.ok for result in results)
+
+
+@pytest.mark.asyncio
+async def test_send_stream_none_item(clear_inbox):
+    await clear_inbox()
+
+    rows = [1, None, 2]
+    mail = Mail(hostname="localhost", port=1025, from_address="from@example.com")
+    results = [
+        result
+        async for result in mail.send_stream(
+            rows, factory=lambda row: row and Message("Hello", to=f"to{row}@example.com")
+        )
+    ]
+    assert len(results) == 3
+    assert [result.ok for result in results] == [True, False, True]
+    assert isinstance(results[1].error, SenderError)
+
+
+@pytest.mark.asyncio
+async def test_send_stream_reconnects_after_disconnect(smtp_server):
+    async def rcpt(address):
+        return "421 Too busy" if address == "busy@example.com" else "250 OK"
+
+    server, port, delivered = await smtp_server(rcpt)
+    recipients = ["to0@example.com", "busy@example.com", "to1@example.com", "to2@example.com"]
+    mail = Mail(hostname="localhost", port=port, from_address="from@example.com")
+    async with server:
+        results = [
+            result
+            async for result in mail.send_stream(
+                recipients, factory=lambda to: Message("Hello", to=to)
+            )
+        ]
+
+    assert [result.ok for result in results] == [True, False, True, True]
+    assert delivered == [["to0@example.com"], ["to1@example.com"], ["to2@example.com"]]
+
+
+@pytest.mark.asyncio
+async def test_domain_scheduler(clear_inbox):
+    await clear_inbox()
+
+    mail = Mail(hostname="localhost", port=1025, from_address="from@example.com")
+    messages = [Message("Hello", to=f"to{i}@example.com") for i in range(3)]
+    messages += [Message("Hello", to="Other <to@Example.org>"), Message("Hello")]
+    scheduler = DomainScheduler(mail, timeout=10, limits={"example.com": {"concurrency": 2}})
+
+    results = [result async for result in scheduler.send(messages)]
+    assert len(results) == 5
+    assert sum(result.ok for result in results) == 4
+    assert set(scheduler.stats) == {"example.com", "example.org", ""}
+    assert scheduler.stats["example.com"].sent == 3
+    assert scheduler.stats["example.org"].sent == 1
+    assert scheduler.stats[""].failed == 1
+    assert scheduler.stats["example.com"].average_latency > 0
+
+
+@pytest.mark.asyncio
+async def test_domain_scheduler_split_message(clear_inbox):
+    await clear_inbox()
+
+    mail = Mail(hostname="localhost", port=1025, from_address="from@example.com")
+    msg = Message("Hello", to=["to@example.com", "to@example.org"], cc="cc@example.com")
+    scheduler = DomainScheduler(mail)
+
+    results = [result async for result in scheduler.send([msg])]
+    assert {frozenset(result.recipients) for result in results} == {
+        frozenset({"to@example.com", "cc@example.com"}),
+        frozenset({"to@example.org"}),
+    }
+    assert all(result.message is msg and result.ok for result in results)
+    assert set(scheduler.stats) == {"example.com", "example.org"}
+
+    async with httpx.AsyncClient() as client:
+        r = await client.get("http://localhost:1080/messages")
+        assert len(r.json()) == 2
+
+
+@pytest.mark.asyncio
+async def test_sharded_sender(clear_inbox):
+    await clear_inbox()
+
+    mail = Mail(hostname="localhost", port=1025, from_address="from@example.com")
+    messages = [Message(f"Hello {i}", to=f"to{i}@example.com") for i in range(6)]
+    messages.append(Message("Hello"))
+    async with ShardedSender(mail, processes=2, chunk_size=2) as sender:
+        results = [result async for result in sender.send(messages[:3])]
+        # the second call reuses the workers and their connections
+        results += [result async for result in sender.send(messages[3:])]
+
+    assert len(results) == 7
+    assert {result.message for result in results} == set(messages)
+    assert sum(result.ok for result in results) == 6
+    # the invalid message fails in this process
+    assert sum(stats.sent for stats in sender.stats.values()) == 6
+    assert sum(stats.failed for stats in sender.stats.values()) == 0
+    assert sum(stats.chunks for stats in sender.stats.values()) == 4
+    assert all(message.from_address == "from@example.com" for message in messages)
+    assert all(message.date is not None for message in messages[:6])
+    assert len(sender.stats) <= 2
+
+    async with httpx.AsyncClient() as client:
+        r = await client.get("http://localhost:1080/messages")
+        assert len(r.json()) == 6
+
+
+@pytest.mark.parametrize("option", ["processes", "concurrency", "chunk_size", "max_chunks"])
+def test_sharded_sender_invalid_options(option):
+    with pytest.raises(ValueError):
+        ShardedSender(Mail(), **{option: 0})
+
+
+@pytest.mark.asyncio
+async def test_domain_scheduler_slow_domain_does_not_block(smtp_server):
+    async def rcpt(address):
+        if address.endswith("@slow.example"):
+            await asyncio.sleep(0.5)
+        return "250 OK"
+
+    server, port, delivered = await smtp_server(rcpt)
+    mail = Mail(hostname="localhost", port=port, from_address="from@example.com")
+    messages = [Message("Hello", to=f"to{i}@slow.example") for i in range(6)]
+    messages += [Message("Hello", to=f"to{i}@fast.example") for i in range(6)]
+    scheduler = DomainScheduler(mail, max_pending=2)
+
+    async with server:
+        results = []
+        stream = scheduler.send(messages)
+        async for result in stream:
+            results.append(result)
+            if len(results) == 7:
+                break
+        await stream.aclose()
+
+    # the queued slow messages do not hold back the fast domain
+    domains = [next(iter(result.recipients)).split("@")[1] for result in results]
+    assert domains == ["fast.example"] * 6 + ["slow.example"]
+    assert scheduler.stats["fast.example"].sent == 6
+
+
+@pytest.mark.asyncio
+async def test_domain_scheduler_timeout_closes_connections():
+    connections = set()
+
+    async def tarpit(reader, writer):
+        # accept, never send a banner
+        connections.add(writer)
+        try:
+            await reader.read()
+        finally:
+            connections.discard(writer)
+
+    server = await asyncio.start_server(tarpit, "localhost", 0)
+    port = server.sockets[0].getsockname()[1]
+    mail = Mail(hostname="localhost", port=port, from_address="from@example.com")
+    scheduler = DomainScheduler(mail, timeout=0.2)
+    messages = [Message("Hello", to=f"to{i}@example.com") for i in range(3)]
+
+    async with server:
+        results = [result async for result in scheduler.send(messages)]
+        await asyncio.sleep(0.1)
+        assert not connections
+    assert [type(result.error) for result in results] == [asyncio.TimeoutError] * 3
+    assert scheduler.stats["example.com"].failed == 3
+
+
+class BlockingPool:
+    """Stands in for the process pool, ``shutdown`` blocks until released."""
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.shutdowns = 0
+
+    def shutdown(self, wait=True):
+        self.shutdowns += 1
+        assert self.released.wait(5)
+
+
+@pytest.mark.asyncio
+async def test_sharded_sender_close_keeps_loop_responsive():
+    sender = ShardedSender(Mail(), processes=1)
+    pool = sender._pool = BlockingPool()
+
+    closing = asyncio.ensure_future(sender.aclose())
+    # shutdown returns only once the loop releases it, so a blocking aclose fails
+    await asyncio.sleep(0.01)
+    assert not closing.done()
+    pool.released.set()
+    await closing
+
+    assert pool.shutdowns == 1
+    assert sender._pool is None
+    await sender.aclose()
+    assert pool.shutdowns == 1